@@ -1,14 +1,26 @@
+import asyncio
+import logging
 import os
-from fastapi import FastAPI, HTTPException, Query
+import re
+import orjson
+from fastapi import FastAPI, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional, Union
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, TypeAdapter, field_validator
+from typing import List, Literal, Optional, Union
+from typing_extensions import TypedDict
+from datetime import datetime
 from bson import ObjectId
+from bson.errors import InvalidId
+from cachetools import TTLCache
+from pymongo import UpdateOne
 
-from database import db, create_document, get_documents
+from database import db, create_document
 from schemas import Product, Order, OrderItem, Customer, SizeStock
 
-app = FastAPI(title="Sepatuku API", version="1.1.0")
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="Sepatuku API", version="1.1.0", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,26 +31,163 @@ app.add_middleware(
 )
 
 
+# Case-insensitive comparison for the category filter; the category index is built with it too
+CATEGORY_COLLATION = {"locale": "en", "strength": 2}
+
+
+# Response shapes for the list endpoints. TypedDicts (not models) so the adapters only
+# serialize: stored documents are never re-validated, missing keys stay missing instead of
+# gaining schema defaults, and unknown keys are dropped.
+class SizeStockOut(TypedDict, total=False):
+    size: Union[str, int]
+    stock: int
+
+class ProductListItem(TypedDict, total=False):
+    id: str
+    title: str
+    price: Union[int, float]
+    image: Optional[str]
+    brand: Optional[str]
+    category: Optional[str]
+    in_stock: bool
+    sizes: List[SizeStockOut]
+
+class ProductDetail(ProductListItem, total=False):
+    description: Optional[str]
+
+class OrderItemOut(TypedDict, total=False):
+    product_id: str
+    title: Optional[str]
+    price: Union[int, float]
+    quantity: int
+    image: Optional[str]
+    size: Union[str, int]
+
+class CustomerOut(TypedDict, total=False):
+    name: str
+    email: str
+    phone: str
+    address: str
+    city: Optional[str]
+    postal_code: Optional[str]
+
+class OrderListItem(TypedDict, total=False):
+    id: str
+    items: List[OrderItemOut]
+    total: Union[int, float]
+    payment_method: str
+    status: str
+    customer: CustomerOut
+    created_at: datetime
+    updated_at: datetime
+
+
+# Built once at import; constructing adapters per request would rebuild their serializers.
+# dump_json writes the response bytes in pydantic-core, which also skips FastAPI's
+# jsonable_encoder walk over the payload.
+PRODUCT_LIST_ADAPTER = TypeAdapter(List[ProductListItem])
+ORDER_LIST_ADAPTER = TypeAdapter(List[OrderListItem])
+PRODUCT_DETAIL_ADAPTER = TypeAdapter(ProductDetail)
+
+
+# Cached /products response bodies keyed by (q, category). Every stock write bumps the
+# generation and clears the cache; a miss only stores its body if the generation is unchanged
+# since before its query, so a write landing mid-query can't leave a stale entry behind.
+# Lookups and stores never span an await, so the event loop keeps them atomic without a lock.
+products_cache = TTLCache(maxsize=256, ttl=30)
+products_cache_generation = 0
+
+
+def invalidate_products_cache():
+    global products_cache_generation
+    products_cache_generation += 1
+    products_cache.clear()
+
+
+# Fields the catalog list view needs; /products/{id} adds the description
+PRODUCT_LIST_PROJECTION = {
+    "title": 1,
+    "price": 1,
+    "image": 1,
+    "brand": 1,
+    "category": 1,
+    "in_stock": 1,
+    "sizes": 1,
+}
+PRODUCT_DETAIL_PROJECTION = {**PRODUCT_LIST_PROJECTION, "description": 1}
+
+# Correct photo for Street Classic; older catalogs were seeded with a wrong image
+STREET_CLASSIC_IMAGE = "https://images.unsplash.com/photo-1519741495605-1f7f1c080b42?w=800&q=80&auto=format&fit=crop"
+
+# QR payload is "SEPATUKU|ORDER:{order_id}|TOTAL:{total}" already URL-encoded; the
+# order id (hex) and integer total need no escaping, so they are appended as-is
+QRIS_QR_URL_PREFIX = "https://api.qrserver.com/v1/create-qr-code/?size=220x220&data=SEPATUKU%7CORDER%3A"
+
+
 # Helpers
 
 def to_str_id(doc):
+    # Mutates in place: the driver already hands us fresh dicts, so copying them is wasted work
     if not doc:
         return doc
+    _str = str
     if isinstance(doc, list):
-        return [to_str_id(d) for d in doc]
-    d = dict(doc)
-    if "_id" in d:
-        d["id"] = str(d["_id"])  # expose as id
-        del d["_id"]
-    return d
+        for d in doc:
+            if "_id" in d:
+                d["id"] = _str(d.pop("_id"))  # expose as id
+        return doc
+    if "_id" in doc:
+        doc["id"] = _str(doc.pop("_id"))
+    return doc
 
 
-def fix_image_urls(p):
-    # Correct wrong photo for Street Classic and ensure https & parameters ok
-    title = p.get("title", "").lower()
-    if "street classic" in title:
-        p["image"] = "https://images.unsplash.com/photo-1519741495605-1f7f1c080b42?w=800&q=80&auto=format&fit=crop"
-    return p
+def stock_update(size, delta):
+    # Pipeline that shifts one size's stock by delta and recomputes in_stock server-side
+    return [
+        {"$set": {"sizes": {"$map": {
+            "input": "$sizes",
+            "as": "s",
+            "in": {"$mergeObjects": ["$$s", {"stock": {"$cond": [
+                {"$eq": ["$$s.size", size]},
+                {"$add": ["$$s.stock", delta]},
+                "$$s.stock",
+            ]}}]},
+        }}}},
+        {"$set": {"in_stock": {"$anyElementTrue": [{"$map": {
+            "input": "$sizes",
+            "in": {"$gt": ["$$this.stock", 0]},
+        }}]}}},
+    ]
+
+
+def stock_decrement(oid, size, qty):
+    # The filter only matches while enough stock remains, so concurrent checkouts can't oversell
+    return (
+        {"_id": oid, "sizes": {"$elemMatch": {"size": size, "stock": {"$gte": qty}}}},
+        stock_update(size, -qty),
+    )
+
+
+def stock_release(oid, size, qty):
+    # Inverse of stock_decrement, used to hand back a reservation whose order never landed
+    return {"_id": oid, "sizes.size": size}, stock_update(size, qty)
+
+
+# Multi-document transactions need a replica set or mongos; standalone servers make
+# checkout fall back to compensating writes instead
+transactions_supported = False
+
+
+@app.on_event("startup")
+async def detect_transactions():
+    global transactions_supported
+    try:
+        if db is None:
+            return
+        hello = await db.command("hello")
+        transactions_supported = "setName" in hello or hello.get("msg") == "isdbgrid"
+    except Exception:
+        pass
 
 
 # Seed products if empty
@@ -47,7 +196,7 @@ async def seed_products():
     try:
         if db is None:
             return
-        count = db["product"].count_documents({})
+        count = await db["product"].estimated_document_count()
         if count == 0:
             seed = [
                 {
@@ -137,7 +286,29 @@ async def seed_products():
                 },
             ]
             for s in seed:
-                create_document("product", s)
+                await create_document("product", s)
+        # Fix stored image URLs once here instead of patching every /products response
+        await db["product"].update_many(
+            {"title": {"$regex": "street classic", "$options": "i"}, "image": {"$ne": STREET_CLASSIC_IMAGE}},
+            {"$set": {"image": STREET_CLASSIC_IMAGE}},
+        )
+    except Exception:
+        pass
+
+
+# Indexes for catalog search and category filtering
+@app.on_event("startup")
+async def ensure_indexes():
+    try:
+        if db is None:
+            return
+        await db["product"].create_index([
+            ("title", "text"),
+            ("description", "text"),
+            ("brand", "text"),
+            ("category", "text"),
+        ])
+        await db["product"].create_index([("category", 1)], collation=CATEGORY_COLLATION)
     except Exception:
         pass
 
@@ -148,43 +319,75 @@ def root():
     return {"message": "Sepatuku API Running"}
 
 @app.get("/products")
-def list_products(q: Optional[str] = Query(None), category: Optional[str] = Query(None)):
+async def list_products(q: Optional[str] = Query(None), category: Optional[str] = Query(None)):
+    cache_key = (q or "", (category or "").lower())
+    cached = products_cache.get(cache_key)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+    generation = products_cache_generation
+
     query = {}
     if q:
-        query["$or"] = [
-            {"title": {"$regex": q, "$options": "i"}},
-            {"description": {"$regex": q, "$options": "i"}},
-            {"brand": {"$regex": q, "$options": "i"}},
-            {"category": {"$regex": q, "$options": "i"}},
-        ]
-    if category:
-        query["category"] = {"$regex": f"^{category}$", "$options": "i"}
-
-    docs = list(db["product"].find(query))
-    docs = [fix_image_urls(d) for d in docs]
-    return to_str_id(docs)
+        query["$text"] = {"$search": q}
+    collation = None
+    if category and q:
+        # Text indexes don't support collations, so filter the (already narrowed) text hits
+        query["category"] = {"$regex": f"^{re.escape(category)}$", "$options": "i"}
+    elif category:
+        query["category"] = category
+        collation = CATEGORY_COLLATION
+
+    docs = await db["product"].find(query, PRODUCT_LIST_PROJECTION, collation=collation).to_list(length=None)
+    body = PRODUCT_LIST_ADAPTER.dump_json(to_str_id(docs))
+    if products_cache_generation == generation:
+        products_cache[cache_key] = body
+    return Response(content=body, media_type="application/json")
+
+@app.get("/products/{product_id}")
+async def get_product(product_id: str):
+    try:
+        oid = ObjectId(product_id)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="ID produk tidak valid")
+    prod = await db["product"].find_one({"_id": oid}, PRODUCT_DETAIL_PROJECTION)
+    if not prod:
+        raise HTTPException(status_code=404, detail=f"Produk tidak ditemukan: {product_id}")
+    return Response(content=PRODUCT_DETAIL_ADAPTER.dump_json(to_str_id(prod)), media_type="application/json")
 
 class CartItem(BaseModel):
     product_id: str
-    quantity: int
+    quantity: int = Field(ge=1)
     size: Union[str, int]
 
 class CheckoutRequest(BaseModel):
     items: List[CartItem]
     customer: Customer
-    payment_method: str
+    payment_method: Literal["COD", "QRIS"]
+
+    @field_validator("payment_method", mode="before")
+    @classmethod
+    def upper_payment_method(cls, v):
+        return v.upper() if isinstance(v, str) else v
 
 @app.post("/checkout")
-def checkout(payload: CheckoutRequest):
+async def checkout(payload: CheckoutRequest):
     # Validate products, sizes, and compute total, decrease stock
     total = 0
-    order_items: List[OrderItem] = []
+    items_data: List[dict] = []
+    decrements = {}
 
-    for item in payload.items:
-        try:
-            prod = db["product"].find_one({"_id": ObjectId(item.product_id)})
-        except Exception:
-            prod = None
+    # Parse every product id once; reused for the lookup and the stock decrements
+    try:
+        oids = [ObjectId(i.product_id) for i in payload.items]
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="ID produk tidak valid")
+
+    # Fetch every product in the cart with a single round trip
+    cursor = db["product"].find({"_id": {"$in": oids}})
+    prods_by_id = {p["_id"]: p async for p in cursor}
+
+    for item, oid in zip(payload.items, oids):
+        prod = prods_by_id.get(oid)
         if not prod:
             raise HTTPException(status_code=400, detail=f"Produk tidak ditemukan: {item.product_id}")
         if not prod.get("in_stock", True):
@@ -195,44 +398,84 @@ def checkout(payload: CheckoutRequest):
         size_entry = next((s for s in sizes if str(s.get("size")) == str(item.size)), None)
         if not size_entry or size_entry.get("stock", 0) < item.quantity:
             raise HTTPException(status_code=400, detail=f"Stok ukuran {item.size} tidak mencukupi untuk {prod.get('title')}")
+        # Track the decrement in memory so repeated lines are checked cumulatively
+        size_entry["stock"] = size_entry.get("stock", 0) - item.quantity
+        key = (oid, size_entry.get("size"))
+        decrements[key] = decrements.get(key, 0) + item.quantity
 
         price = float(prod.get("price", 0))
         total += price * item.quantity
-        order_items.append(OrderItem(
-            product_id=str(prod["_id"]),
-            title=prod.get("title"),
-            price=price,
-            quantity=item.quantity,
-            image=prod.get("image"),
-            size=item.size,
-        ))
-
-    pm = payload.payment_method.upper()
-    if pm not in ["COD", "QRIS"]:
-        raise HTTPException(status_code=400, detail="Metode pembayaran tidak didukung")
-
-    order = Order(
-        items=order_items,
+        items_data.append({
+            "product_id": str(prod["_id"]),
+            "title": prod.get("title"),
+            "price": price,
+            "quantity": item.quantity,
+            "image": prod.get("image"),
+            "size": item.size,
+        })
+
+    pm = payload.payment_method
+
+    # Every field was already validated above (or by CheckoutRequest), so skip re-validation
+    order = Order.model_construct(
+        items=[OrderItem.model_construct(**d) for d in items_data],
         total=total,
         payment_method=pm,
         status="pending" if pm == "QRIS" else "cod-confirmed",
         customer=payload.customer
     )
 
-    order_id = create_document("order", order)
+    # Reduce stock per size (each op also refreshes the product's in_stock flag) and
+    # record the order; a failed line or insert must leave stock untouched
+    lines = list(decrements.items())
+    if transactions_supported:
+        async with await db.client.start_session() as session:
+            async with session.start_transaction():
+                if lines:
+                    result = await db["product"].bulk_write(
+                        [UpdateOne(*stock_decrement(oid, size, qty)) for (oid, size), qty in lines],
+                        ordered=False,
+                        session=session,
+                    )
+                    if result.matched_count < len(lines):
+                        raise HTTPException(status_code=409, detail="Stok berubah saat checkout, silakan coba lagi")
+                order_id = await create_document("order", order, session=session)
+    else:
+        # No transactions on this deployment: reserve each line on its own (concurrently) so
+        # we know exactly which ones landed, and release them if the checkout can't complete
+        reserved = []
 
-    # Reduce stock per size atomically (best effort per item)
-    for oi in order_items:
-        db["product"].update_one(
-            {"_id": ObjectId(oi.product_id), "sizes.size": oi.size},
-            {"$inc": {"sizes.$.stock": -oi.quantity}}
-        )
-        # Update in_stock flag if all sizes depleted
-        prod = db["product"].find_one({"_id": ObjectId(oi.product_id)})
-        if prod:
-            sizes = prod.get("sizes", [])
-            if all((s.get("stock", 0) <= 0) for s in sizes):
-                db["product"].update_one({"_id": ObjectId(oi.product_id)}, {"$set": {"in_stock": False}})
+        async def reserve(line):
+            (oid, size), qty = line
+            result = await db["product"].update_one(*stock_decrement(oid, size, qty))
+            if result.matched_count:
+                reserved.append(line)
+            return result
+
+        try:
+            try:
+                results = await asyncio.gather(*(reserve(line) for line in lines), return_exceptions=True)
+            finally:
+                invalidate_products_cache()
+            for r in results:
+                if isinstance(r, BaseException):
+                    raise r
+            if len(reserved) < len(lines):
+                raise HTTPException(status_code=409, detail="Stok berubah saat checkout, silakan coba lagi")
+            order_id = await create_document("order", order)
+        except BaseException:
+            # Runs on cancellation too; a failed release is logged rather than masking the original error
+            if reserved:
+                try:
+                    await db["product"].bulk_write(
+                        [UpdateOne(*stock_release(oid, size, qty)) for (oid, size), qty in reserved],
+                        ordered=False,
+                    )
+                except Exception:
+                    logger.exception("Failed to release reserved stock: %s", reserved)
+                invalidate_products_cache()
+            raise
+    invalidate_products_cache()
 
     response = {
         "order_id": order_id,
@@ -243,11 +486,7 @@ def checkout(payload: CheckoutRequest):
 
     if pm == "QRIS":
         # For demo, return a placeholder QR code image URL encoding order id + total
-        import urllib.parse
-        qr_text = f"SEPATUKU|ORDER:{order_id}|TOTAL:{int(total)}"
-        encoded = urllib.parse.quote(qr_text)
-        qr_url = f"https://api.qrserver.com/v1/create-qr-code/?size=220x220&data={encoded}"
-        response["qris_qr_url"] = qr_url
+        response["qris_qr_url"] = f"{QRIS_QR_URL_PREFIX}{order_id}%7CTOTAL%3A{int(total)}"
         response["instructions"] = "Scan QRIS untuk menyelesaikan pembayaran."
     else:
         response["instructions"] = "Pesanan COD dikonfirmasi. Siapkan pembayaran tunai saat kurir datang."
@@ -255,12 +494,23 @@ def checkout(payload: CheckoutRequest):
     return response
 
 @app.get("/orders")
-def list_orders():
-    docs = get_documents("order")
-    return to_str_id(docs)
+async def list_orders(limit: int = Query(50, ge=1, le=200), skip: int = Query(0, ge=0)):
+    # Newest first, one page at a time so memory stays bounded as orders grow
+    cursor = db["order"].find().sort("_id", -1).skip(skip).limit(limit)
+    docs = await cursor.to_list(length=limit)
+    return Response(content=ORDER_LIST_ADAPTER.dump_json(to_str_id(docs)), media_type="application/json")
+
+@app.get("/orders/export")
+async def export_orders():
+    # Full export as NDJSON, streamed straight off the cursor one order per line
+    async def generate():
+        async for doc in db["order"].find().sort("_id", -1):
+            yield orjson.dumps(to_str_id(doc)) + b"\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(app, host="0.0.0.0", port=port, loop="uvloop", http="httptools")